@@ -1,21 +1,43 @@
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import Flask, Response, render_template, request, jsonify
+from flask.json.provider import JSONProvider
 import lead_hunter  # il tuo script esistente
 import csv
-import json
+import orjson
 from io import StringIO
-import subprocess
 import os
+import uuid
+
+class OrjsonProvider(JSONProvider):
+    # jsonify/request.get_json con orjson invece del modulo json standard
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
-# ---------------- PLAYWRIGHT FIX ----------------
-# se i browser non sono installati, li installa automaticamente
-if not os.path.exists(os.path.expanduser("~/.cache/ms-playwright")):
-    print("Playwright browsers non trovati, installo Chromium...")
-    subprocess.run(["playwright", "install", "chromium"], check=True)
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+
+QUERY_CACHE_TTL = 900  # s, risultati di /api/scrape riusati per la stessa query
+
+# gli ultimi lead di ogni utente stanno nella cache condivisa (Redis se REDIS_URL è impostato),
+# non in memoria del worker: l'export funziona anche se arriva a un altro worker gunicorn
+LEADS_TTL = 1800  # s
+SESSION_COOKIE = "leads_sid"
+
+def session_leads():
+    sid = request.cookies.get(SESSION_COOKIE)
+    return (lead_hunter.cache_get(f"leads:{sid}", store="sessions") if sid else None) or []
 
-# memorizziamo gli ultimi lead raccolti in memoria
-latest_leads = []
+def stream_json(items):
+    # serializza un lead alla volta: il primo byte parte subito, senza bufferizzare tutta la lista
+    def generate():
+        yield b"["
+        for i, item in enumerate(items):
+            yield (b"," if i else b"") + orjson.dumps(item)
+        yield b"]"
+    return Response(generate(), mimetype='application/json')
 
 # ---------------------- ROUTES ----------------------
 
@@ -26,64 +48,75 @@ def index():
 
 @app.route('/api/scrape', methods=['POST'])
 def api_scrape():
-    global latest_leads
     data = request.get_json()
     query = data.get('query', '').strip()
     if not query:
         return jsonify({"error": "Query vuota"}), 400
 
     try:
-        leads = lead_hunter.run_pipeline(query)
+        cache_key = "query:" + " ".join(query.lower().split())
+        leads = lead_hunter.cache_get(cache_key)
+        if leads is None:
+            leads = lead_hunter.run_pipeline(query)
+            if leads:
+                lead_hunter.cache_set(cache_key, QUERY_CACHE_TTL, leads)
         print(f"[DEBUG] Lead trovati: {len(leads)}")  # <-- aggiungi questa riga
-        latest_leads = leads
-        return jsonify(leads)
+        sid = request.cookies.get(SESSION_COOKIE) or uuid.uuid4().hex
+        lead_hunter.cache_set(f"leads:{sid}", LEADS_TTL, leads, store="sessions")
+        resp = stream_json(leads)
+        resp.set_cookie(SESSION_COOKIE, sid, max_age=LEADS_TTL, httponly=True, samesite='Lax')
+        return resp
     except Exception as e:
         print(f"[ERROR] {str(e)}")
         return jsonify({"error": f"Errore durante l'analisi: {str(e)}"}), 500
 
 @app.route('/export/csv')
 def export_csv():
-    global latest_leads
-    if not latest_leads:
+    leads = session_leads()
+    if not leads:
         return "Nessun lead da esportare", 400
 
-    si = StringIO()
-    writer = csv.writer(si)
-    # header
-    writer.writerow(["Platform", "Source Title", "Landing", "Domain", "Emails", "Phones", "Contact Page", "Score"])
-
-    for lead in latest_leads:
-        analysis = lead.get('analysis', {})
-        writer.writerow([
-            lead.get('platform', ''),
-            lead.get('source_title', ''),
-            lead.get('landing', ''),
-            lead.get('domain', ''),
-            ", ".join(analysis.get('emails', [])),
-            ", ".join(analysis.get('phones', [])),
-            analysis.get('contact_page', ''),
-            analysis.get('score', 0)
-        ])
-
-    si.seek(0)
-    return send_file(
-        StringIO(si.getvalue()),
+    def generate():
+        # una riga alla volta nello stesso buffer: in memoria c'è sempre solo la riga corrente
+        buf = StringIO()
+        writer = csv.writer(buf)
+        # header
+        writer.writerow(["Platform", "Source Title", "Landing", "Domain", "Emails", "Phones", "Contact Page", "Score"])
+        yield buf.getvalue()
+
+        for lead in leads:
+            buf.seek(0)
+            buf.truncate()
+            analysis = lead.get('analysis', {})
+            writer.writerow([
+                lead.get('platform', ''),
+                lead.get('source_title', ''),
+                lead.get('landing', ''),
+                lead.get('domain', ''),
+                ", ".join(analysis.get('emails', [])),
+                ", ".join(analysis.get('phones', [])),
+                analysis.get('contact_page', ''),
+                analysis.get('score', 0)
+            ])
+            yield buf.getvalue()
+
+    return Response(
+        generate(),
         mimetype='text/csv',
-        as_attachment=True,
-        download_name='leads.csv'
+        headers={'Content-Disposition': 'attachment; filename=leads.csv'}
     )
 
 
 @app.route('/export/json')
 def export_json():
-    global latest_leads
-    if not latest_leads:
+    leads = session_leads()
+    if not leads:
         return "Nessun lead da esportare", 400
 
-    return jsonify(latest_leads)
+    return stream_json(leads)
 
 
 if __name__ == '__main__':
-    # usa gunicorn se disponibile, altrimenti flask
+    # solo per sviluppo locale: in produzione l'app gira con gunicorn (vedi Procfile)
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port)
@@ -1,36 +1,73 @@
 # lead_hunter.py
 # Single-file scraper per Meta Ads Library, Reddit, LinkedIn
-# - usa Playwright per renderizzare JS
+# - usa Playwright (async) per renderizzare JS, con un pool di pagine in parallelo
 # - salva leads.json
 
-import time, re, json
-from urllib.parse import urlparse, urljoin, quote_plus
-from collections import defaultdict
+import time, re, asyncio, os, hashlib, subprocess, functools, threading, atexit, random
+from urllib.parse import urlparse, urlunparse, urljoin, quote_plus, unquote, parse_qs, parse_qsl, urlencode
+from urllib.robotparser import RobotFileParser
+from collections import defaultdict, OrderedDict
 
-import requests
-from bs4 import BeautifulSoup
-from fake_useragent import UserAgent
+import httpx
+import orjson
+import redis
+from selectolax.lexbor import LexborHTMLParser
 import tldextract
 import textstat
-from playwright.sync_api import sync_playwright, TimeoutError as PlayTimeoutError
+from playwright.async_api import async_playwright, TimeoutError as PlayTimeoutError
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
 # ---------------- CONFIG ----------------
 QUERY_PROMPT = "Query: "
 PLATFORMS = ["meta", "reddit", "linkedin"]
 MAX_PER_PLATFORM = 200
 MAX_PER_DOMAIN = 200
-POLITE_SLEEP = 1.0
+POLITE_SLEEP = 1.0  # s, pausa tra due richieste allo stesso dominio se robots.txt non indica Crawl-delay
+MAX_CRAWL_DELAY = 10.0  # s, tetto al Crawl-delay dichiarato
+ROBOTS_TIMEOUT = 3.0  # s, per scaricare robots.txt
+ROBOTS_TTL = 3600  # s, validità del Crawl-delay letto da robots.txt
+ROBOTS_CACHE_SIZE = 1024  # host tenuti in memoria
+COPY_TEXT_LIMIT = 10_000  # caratteri di copy (p/h1/h2/h3) valutati per la qualità del testo
+POOL_SIZE = 6  # contesti Playwright (incognito) usati in parallelo
+# risorse inutili per l'analisi del testo: bloccate prima di partire
+BLOCKED_RESOURCES = {"image", "media", "font", "stylesheet"}
+# analytics/pixel: non aggiungono testo alla pagina, solo richieste in più
+TRACKER_DOMAINS = frozenset({
+    "google-analytics.com", "googletagmanager.com", "doubleclick.net", "googlesyndication.com",
+    "connect.facebook.net", "hotjar.com", "clarity.ms", "analytics.tiktok.com", "px.ads.linkedin.com",
+})
+NON_TEXT_SELECTOR = 'style, noscript, template, script:not([type="application/ld+json"])'
+SETTLE_TIMEOUT = 1000  # ms, attesa massima dell'evento load dopo domcontentloaded
 PAGE_TIMEOUT = 20000  # ms
+CACHE_TTL = 86400  # s, validità di un'analisi landing in cache
+REDIS_URL = os.environ.get("REDIS_URL")  # se assente la cache resta in memoria del processo
+REDIS_TIMEOUT = 2.0  # s, per connessione e singola chiamata Redis
+BROWSERS_DIR = os.path.expanduser("~/.cache/ms-playwright")
 
-SOCIAL_BLOCK_DOMAINS = {
+SOCIAL_BLOCK_DOMAINS = frozenset({
     "reddit.com", "redditinc.com", "redditblog.com", "metastatus.com",
     "reddithelp.com", "facebook.com","m.facebook.com","whatsapp.com",
     "wa.me","t.me","t.co","instagram.com","docs.google.com",
     "forms.gle","fb.com", "zoom.us"
-}
+})
+
+# User-Agent di browser desktop reali: basta che non sembri un bot
+USER_AGENTS = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36 Edg/123.0.0.0",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:125.0) Gecko/20100101 Firefox/125.0",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.4 Safari/605.1.15",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 14.4; rv:125.0) Gecko/20100101 Firefox/125.0",
+    "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:125.0) Gecko/20100101 Firefox/125.0",
+)
 
-ua = UserAgent()
-HEADERS = {"User-Agent": ua.random}
+def random_ua():
+    return random.choice(USER_AGENTS)
 
 # Pesi per il punteggio lead
 WEIGHTS = {
@@ -43,166 +80,375 @@ WEIGHTS = {
     "has_cta": 12,
 }
 
-EMAIL_RE = re.compile(r"[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+")
-PHONE_RE = re.compile(r"(?:\+?\d{1,3})?[\s\-\.\(]*\d{2,4}[\)\s\-\.\d]{5,20}")
+# \b ai due estremi: niente backtracking da metà parola e niente punto finale nel dominio
+_EMAIL = r"\b[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+\b"
+# numero italiano a 10 cifre (0/3 iniziale) nel testo formattato, con prefisso +39 opzionale;
+# le date ("03/10/2024 14:30", "15/03/2024 10.15") non valgono come numero
+_IT_PHONE = (r"(?<![\d+])(?<!\d[/.\-])(?:(?:\+|00)39[\s.\-]?)?"
+             r"(?!\d{1,2}/\d{1,2}/\d{2,4}|\d{1,2}[.\-]\d{1,2}[.\-](?:19|20)\d\d(?!\d))"
+             r"(?P<number>[03](?:[\s./()\-]{0,2}\d){9})(?!\d)")
+IT_PHONE_RE = re.compile(_IT_PHONE)
+# email e telefoni insieme: il testo della pagina viene scandito una volta sola
+CONTACT_SCAN_RE = re.compile(f"(?P<email>{_EMAIL})|(?P<phone>{_IT_PHONE})")
+NONDIGIT_RE = re.compile(r"\D")
+WORD_RE = re.compile(r"\w+")
+SENTENCE_SPLIT_RE = re.compile(r"[.!?]+")
+TRACKING_PARAM_RE = re.compile(r"utm_|(?:fbclid|gclid|mc_cid|mc_eid)$", re.I)  # parametri che non cambiano la landing
+# parole frequenti solo in inglese: bastano a capire se ha senso usare Flesch
+EN_STOPWORDS = frozenset(["the","and","of","to","is","you","your","for","with","that","this","are","our"])
+# parole chiave compilate una volta sola in un'unica alternanza
+CTA_RE = re.compile(r"iscriviti|prenota|contattaci|scopri|richiedi|invia|book|sign up|subscribe|free|ottieni", re.I)
+CONTACT_RE = re.compile(r"contact|contatt", re.I)
+
+# lista dei suffissi pubblici dallo snapshot incluso nel pacchetto: niente download,
+# e cache_dir=None evita anche la cache (e il lock) su disco
+EXTRACTOR = tldextract.TLDExtract(cache_dir=None, suffix_list_urls=())
+
+# ---------------- CACHE ----------------
+# timeout brevi: una chiamata Redis appesa non deve bloccare le pipeline in corso
+_redis = redis.Redis.from_url(REDIS_URL, socket_timeout=REDIS_TIMEOUT, socket_connect_timeout=REDIS_TIMEOUT) if REDIS_URL else None
+# senza Redis: nome -> LRU chiave -> (scadenza, json), usate sia dai thread Flask sia dal loop di Playwright;
+# i lead per l'export hanno la loro, così le analisi delle landing non li fanno uscire prima del TTL
+_local_stores = {"cache": OrderedDict(), "sessions": OrderedDict()}
+LOCAL_STORE_SIZES = {"cache": 4096, "sessions": 512}
+_local_cache_lock = threading.Lock()
+
+def cache_get(key, store="cache"):
+    if _redis is not None:
+        try: raw = _redis.get(key)
+        except redis.RedisError: return None
+        return orjson.loads(raw) if raw else None
+    local = _local_stores[store]
+    with _local_cache_lock:
+        hit = local.get(key)
+        if hit is None: return None
+        if hit[0] <= time.time():
+            del local[key]
+            return None
+        local.move_to_end(key)
+    return orjson.loads(hit[1])
+
+def cache_set(key, ttl, value, store="cache"):
+    data = orjson.dumps(value)
+    if _redis is not None:
+        try: _redis.setex(key, ttl, data)
+        except redis.RedisError: pass
+        return
+    local = _local_stores[store]
+    with _local_cache_lock:
+        local[key] = (time.time() + ttl, data)
+        local.move_to_end(key)
+        if len(local) > LOCAL_STORE_SIZES[store]:
+            local.popitem(last=False)
+
+# dal loop di Playwright: le chiamate Redis sono bloccanti e vanno in un thread,
+# altrimenti fermano tutte le pipeline che condividono il loop
+async def acache_get(key):
+    if _redis is None: return cache_get(key)
+    return await asyncio.to_thread(cache_get, key)
+
+async def acache_set(key, ttl, value):
+    if _redis is None: return cache_set(key, ttl, value)
+    await asyncio.to_thread(cache_set, key, ttl, value)
+
+def landing_cache_key(url):
+    # chiave sulla landing normalizzata: gli utm_* diversi non fanno mancare la cache
+    return "lead:" + hashlib.blake2b(normalize_url(url).encode(), digest_size=16).hexdigest()
 
 # ---------------- HELPERS ----------------
+@functools.lru_cache(maxsize=8192)
 def is_blocked_social(url):
+    # host uguale a un dominio bloccato o suo sottodominio (www.facebook.com, l.facebook.com);
+    # confronto esatto per etichette, così "t.co" non blocca "art.com"
     try:
-        net = urlparse(url).netloc.lower()
-        return any(s in net for s in SOCIAL_BLOCK_DOMAINS)
-    except:
+        labels = (urlparse(url).hostname or "").split(".")
+    except ValueError:
         return False
+    return any(".".join(labels[i:]) in SOCIAL_BLOCK_DOMAINS for i in range(len(labels) - 1))
 
-def extract_emails(text):
-    emails = EMAIL_RE.findall(text or "")
-    return [e for e in emails if "@" in e and "..." not in e]
-
-def extract_phones(text):
-    digits_only = re.sub(r"\D", "", text)
-    candidates = re.findall(r"(?:0|3)\d{8,9}", digits_only)
-    for p in candidates:
-        if len(p) == 10:
-            if p.startswith("0"):
-                return ["+39" + p]
-            elif p.startswith("3"):
-                return ["+39" + p]
-    return []
+def extract_contacts(text, mailto_links=(), tel_links=()):
+    # i link mailto:/tel: sono più affidabili del testo e vengono prima;
+    # delle email si tengono tutte, del telefono solo il primo
+    emails = list(mailto_links)
+    phones = []
+    for link in tel_links:
+        m = IT_PHONE_RE.search(link)
+        if m:
+            phones = ["+39" + NONDIGIT_RE.sub("", m.group("number"))]
+            break
+    for m in CONTACT_SCAN_RE.finditer(text or ""):
+        if m.group("email"):
+            emails.append(m.group("email"))
+        elif not phones:
+            phones = ["+39" + NONDIGIT_RE.sub("", m.group("number"))]
+    emails = list(dict.fromkeys(e for e in emails if "@" in e and "..." not in e))
+    return emails, phones
 
+@functools.lru_cache(maxsize=4096)
 def domain_of(url):
     try:
-        return tldextract.extract(url).registered_domain or urlparse(url).netloc
+        return EXTRACTOR(url).registered_domain or urlparse(url).netloc
     except:
-        return urlparse(url).netloc
+        try: return urlparse(url).netloc
+        except ValueError: return ""
+
+def has_host(url):
+    # href malformati ("http://[bad") o senza host: inutile spenderci un caricamento
+    try: return bool(urlparse(url).hostname)
+    except ValueError: return False
 
-def safe_text(soup):
-    return (soup.get_text(" ", strip=True) if soup else "")
+def normalize_url(url):
+    # stessa landing anche se cambiano parametri di tracciamento, ordine dei parametri,
+    # frammento, maiuscole nell'host, "www." o slash finale;
+    # un href malformato (es. "http://[shop.it/x") resta com'è invece di far saltare la piattaforma
+    try:
+        p = urlparse(url)
+    except ValueError:
+        return url
+    host = p.netloc.lower().removeprefix("www.")
+    qs = [(k, v) for k, v in parse_qsl(p.query, keep_blank_values=True) if not TRACKING_PARAM_RE.match(k)]
+    return urlunparse((p.scheme.lower(), host, p.path.rstrip("/"), "", urlencode(sorted(qs)), ""))
+
+def safe_text(tree):
+    body = tree.body if tree else None
+    return body.text(separator=" ", strip=True) if body else ""
+
+_copy_quality_cache = OrderedDict()  # digest del testo -> punteggio, LRU
+COPY_QUALITY_CACHE_SIZE = 2048
 
 def copy_quality_score(text):
+    # molte landing condividono lo stesso copy (template, franchising): chiave = digest,
+    # così la cache non tiene in memoria i testi
+    key = hashlib.blake2b((text or "").encode("utf-8", "ignore"), digest_size=16).digest()
+    score = _copy_quality_cache.get(key)
+    if score is not None:
+        _copy_quality_cache.move_to_end(key)
+        return score
+    score = _copy_quality(text)
+    _copy_quality_cache[key] = score
+    if len(_copy_quality_cache) > COPY_QUALITY_CACHE_SIZE:
+        _copy_quality_cache.popitem(last=False)
+    return score
+
+def _copy_quality(text):
     if not text or len(text.split()) < 20:
         return 0.0
-    try:
-        flesch = textstat.flesch_reading_ease(text)
-        return 1.0 if flesch >= 60 else 0.6 if flesch >= 40 else 0.3
-    except:
-        return 0.0
+    words = WORD_RE.findall(text.lower())
+    if sum(w in EN_STOPWORDS for w in words) >= 0.08 * len(words):
+        # Flesch è tarato sull'inglese: lo usiamo solo lì
+        try:
+            flesch = textstat.flesch_reading_ease(text)
+            return 1.0 if flesch >= 60 else 0.6 if flesch >= 40 else 0.3
+        except:
+            return 0.0
+    # altre lingue (quasi sempre italiano): lunghezza media delle frasi
+    sentences = [x for x in SENTENCE_SPLIT_RE.split(text) if x.strip()]
+    avg_len = len(words) / max(1, len(sentences))
+    return 1.0 if avg_len <= 20 else 0.6 if avg_len <= 30 else 0.3
 
-def has_schema_org(soup):
-    if not soup: return False
-    return bool(soup.find_all(attrs={"itemscope": True}) or soup.find_all("script", type="application/ld+json"))
-
-def has_cta(soup):
-    if not soup: return False
-    cta_words = ["iscriviti","prenota","contattaci","scopri","richiedi","invia","book","sign up","subscribe","free","ottieni"]
-    for el in soup.find_all(["a","button"]):
-        txt = (el.get_text() or "").lower()
-        if any(w in txt for w in cta_words):
-            return True
-    return False
-
-def find_contact_page(soup, base_url):
-    if not soup: return None
-    for a in soup.find_all("a", href=True):
-        href = a["href"].lower()
-        txt = (a.get_text() or "").lower()
-        if any(k in href for k in ["contact","contatt","contatti","contatto","contacts","contact-us"]) or \
-           any(k in txt for k in ["contatt","contact","contatti","contatto"]):
-            return urljoin(base_url, a["href"])
-    return None
+def has_schema_org(tree):
+    if not tree: return False
+    return bool(tree.css_first('[itemscope], script[type="application/ld+json"]'))
+
+def analyze_anchors(tree, base_url):
+    # un solo passaggio su link e pulsanti: il testo di ogni elemento è letto una volta
+    # e condiviso tra la ricerca delle CTA e quella della pagina contatti
+    if not tree: return {"has_cta": False, "contact_page": None}
+    nodes = tree.css("a, button")
+    texts = [el.text() or "" for el in nodes]
+    # un elemento per riga, una sola ricerca
+    has_cta = bool(CTA_RE.search("\n".join(texts)))
+
+    # prima l'href, filtrato direttamente dal motore CSS; poi il testo del link
+    contact_page = None
+    a = tree.css_first('a[href*="contact" i], a[href*="contatt" i]')
+    if a:
+        contact_page = urljoin(base_url, a.attributes["href"])
+    else:
+        # testi dei link separati da \0 (assente nel testo HTML): una sola ricerca,
+        # e l'indice del link che ha fatto match si ricava contando i separatori
+        links = [i for i, el in enumerate(nodes) if el.tag == "a" and el.attributes.get("href")]
+        blob = "\0".join(texts[i] for i in links)
+        m = CONTACT_RE.search(blob)
+        if m: contact_page = urljoin(base_url, nodes[links[blob.count("\0", 0, m.start())]].attributes["href"])
+    return {"has_cta": has_cta, "contact_page": contact_page}
 
 def normalize_score(raw):
     return max(0, min(100, int(round(raw))))
 
 # ---------------- PLATFORM SCRAPERS ----------------
-def scrape_meta_ads(page, query, max_items):
+# ogni scraper deduplica le sue landing; i doppioni tra piattaforme li toglie la pipeline
+
+async def scrape_meta_ads(page, query, max_items):
     out = []
+    seen = set()
     q = quote_plus(query)
     url = f"https://www.facebook.com/ads/library/?active_status=all&ad_type=all&country=IT&q={q}"
-    try: page.goto(url, timeout=PAGE_TIMEOUT)
+    try: await page.goto(url, timeout=PAGE_TIMEOUT)
     except: pass
-    time.sleep(2)
-    soup = BeautifulSoup(page.content(), "html.parser")
+    await asyncio.sleep(2)
+    tree = LexborHTMLParser(await page.content())
     candidates = []
-    for a in soup.find_all("a", href=True):
-        href = a["href"]
+    # link assoluti più i redirect l.php anche relativi al protocollo ("//l.facebook.com/l.php?u=…"):
+    # il filtro lo fa il selettore, in C
+    for a in tree.css('a[href^="http"], a[href*="l.facebook.com/l.php"]'):
+        href = a.attributes["href"]
         if "l.facebook.com/l.php" in href:
-            m = re.search(r"u=(https%3A%2F%2F[^&]+)", href)
-            landing = requests.utils.unquote(m.group(1)) if m else href
+            # parse_qs decodifica già il parametro: niente unquote
+            landing = parse_qs(urlparse(href).query).get("u", [href])[0]
         else:
             landing = href
         if landing.startswith("http") and not is_blocked_social(landing):
-            candidates.append((a.get_text() or "", landing))
-    seen = set()
+            candidates.append((a.text() or "", landing))
     for txt, landing in candidates:
-        landing_norm = landing.split("?")[0]
+        landing_norm = normalize_url(landing)
         if landing_norm in seen: continue
         seen.add(landing_norm)
         out.append({"platform":"meta","title":txt.strip()[:200],"text":txt.strip(),"landing":landing})
         if len(out)>=max_items: break
     return out
 
-def scrape_reddit(page, query, max_items):
+async def scrape_reddit(page, query, max_items):
     out=[]
+    seen=set()
     url=f"https://www.reddit.com/search/?q={quote_plus(query)}&type=link"
-    try: page.goto(url, timeout=PAGE_TIMEOUT)
+    try: await page.goto(url, timeout=PAGE_TIMEOUT)
     except: pass
-    time.sleep(1)
-    soup=BeautifulSoup(page.content(), "html.parser")
-    seen=set()
-    for a in soup.find_all("a", href=True):
-        href = a["href"]
-        txt = a.get_text(" ",strip=True)[:200]
-        if href.startswith("http") and "reddit.com" not in href and not is_blocked_social(href):
-            if href in seen: continue
-            seen.add(href)
+    await asyncio.sleep(1)
+    tree=LexborHTMLParser(await page.content())
+    # link esterni assoluti: schema e dominio filtrati dal selettore, in C
+    for a in tree.css('a[href^="http"]:not([href*="reddit.com"])'):
+        href = a.attributes["href"]
+        txt = a.text(separator=" ",strip=True)[:200]
+        if not is_blocked_social(href):
+            norm=normalize_url(href)
+            if norm in seen: continue
+            seen.add(norm)
             out.append({"platform":"reddit","title":txt,"text":txt,"landing":href})
             if len(out)>=max_items: break
     return out
 
-def scrape_linkedin(page, query, max_items):
+async def scrape_linkedin(page, query, max_items):
     out=[]
+    seen=set()
     url=f"https://www.linkedin.com/search/results/content/?keywords={quote_plus(query)}"
-    try: page.goto(url, timeout=PAGE_TIMEOUT)
+    try: await page.goto(url, timeout=PAGE_TIMEOUT)
     except: pass
-    time.sleep(1)
-    soup=BeautifulSoup(page.content(),"html.parser")
-    seen=set()
-    for a in soup.find_all("a", href=True):
-        href=a["href"]
-        txt=a.get_text(" ",strip=True)[:200]
-        if href.startswith("http") and "linkedin.com" not in href and not is_blocked_social(href):
-            if href in seen: continue
-            seen.add(href)
+    await asyncio.sleep(1)
+    tree=LexborHTMLParser(await page.content())
+    # link esterni assoluti: schema e dominio filtrati dal selettore, in C
+    for a in tree.css('a[href^="http"]:not([href*="linkedin.com"])'):
+        href=a.attributes["href"]
+        txt=a.text(separator=" ",strip=True)[:200]
+        if not is_blocked_social(href):
+            norm=normalize_url(href)
+            if norm in seen: continue
+            seen.add(norm)
             out.append({"platform":"linkedin","title":txt,"text":txt,"landing":href})
             if len(out)>=max_items: break
     return out
 
 # ---------------- LANDING ANALYZER ----------------
-def analyze_landing(page, landing_url):
+_http_client = None
+
+async def rotate_user_agent(request):
+    # ogni richiesta del client esce con un User-Agent scelto al momento
+    request.headers["User-Agent"] = random_ua()
+
+def get_http_client():
+    # un solo client per processo, creato sul loop di Playwright e condiviso tra pipeline:
+    # connessioni keep-alive e HTTP/2 riusate tra landing dello stesso host
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            http2=True,
+            timeout=8.0,
+            event_hooks={"request": [rotate_user_agent]},
+            follow_redirects=True,
+            # con transport= esplicito i limits del client sono ignorati: vanno sul transport
+            transport=httpx.AsyncHTTPTransport(
+                http2=True, retries=2,
+                limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+            ),
+        )
+    return _http_client
+
+# "schema://host" -> (scadenza, Crawl-delay), LRU; usata solo dal loop di Playwright
+_robots_cache = OrderedDict()
+
+def origin_of(url):
+    p = urlparse(url)
+    return f"{p.scheme}://{p.netloc}"
+
+async def crawl_delay(client, origin):
+    hit = _robots_cache.get(origin)
+    if hit and hit[0] > time.time():
+        _robots_cache.move_to_end(origin)
+        return hit[1]
+    rp = RobotFileParser()
+    try:
+        r = await client.get(origin + "/robots.txt", timeout=ROBOTS_TIMEOUT)
+        rp.parse(r.text.splitlines() if r.status_code == 200 else [])
+    except:
+        rp.parse([])
+    delay = rp.crawl_delay("*")
+    delay = POLITE_SLEEP if delay is None else min(float(delay), MAX_CRAWL_DELAY)
+    _robots_cache[origin] = (time.time() + ROBOTS_TTL, delay)
+    _robots_cache.move_to_end(origin)
+    if len(_robots_cache) > ROBOTS_CACHE_SIZE:
+        _robots_cache.popitem(last=False)
+    return delay
+
+async def fetch_html(client, url):
+    # fallback senza browser quando Playwright non riesce a caricare la pagina
+    try: return (await client.get(url)).text
+    except: return ""
+
+async def analyze_landing(context, landing_url, client):
     info={"url":landing_url,"emails":[],"phones":[],"contact_page":None,"has_contact_form":False,
           "has_schema":False,"has_cta":False,"copy_quality":0.0,"title":"","score":0}
+    page=await context.new_page()
     try:
-        page.goto(landing_url, timeout=PAGE_TIMEOUT)
-        time.sleep(1)
-        html=page.content()
+        await page.goto(landing_url, timeout=PAGE_TIMEOUT, wait_until="domcontentloaded")
+        # senza immagini e font l'evento load arriva presto: si aspetta quello, non un tempo fisso
+        try: await page.wait_for_load_state("load", timeout=SETTLE_TIMEOUT)
+        except PlayTimeoutError: pass
+        html=await page.content()
     except PlayTimeoutError:
-        try: html=requests.get(landing_url, headers=HEADERS, timeout=8).text
-        except: html=""
+        html=await fetch_html(client, landing_url)
     except:
-        try: html=requests.get(landing_url, headers=HEADERS, timeout=8).text
-        except: html=""
+        html=await fetch_html(client, landing_url)
+    finally:
+        await page.close()
 
     if not html: return info
-    soup=BeautifulSoup(html,"html.parser")
-    info["title"]=soup.title.string.strip() if soup.title else ""
-    txt=safe_text(soup)
-    info["emails"]=extract_emails(html+" "+txt)
-    info["phones"]=extract_phones(html+" "+txt)
-    info["contact_page"]=find_contact_page(soup, landing_url)
-    info["has_contact_form"]=bool(soup.find("form"))
-    info["has_schema"]=has_schema_org(soup)
-    info["has_cta"]=has_cta(soup)
-    info["copy_quality"]=copy_quality_score(" ".join([p.get_text(" ",strip=True) for p in soup.find_all(["p","h1","h2","h3"])]))
+    tree=LexborHTMLParser(html)
+    title_el=tree.css_first("title")
+    info["title"]=title_el.text(strip=True) if title_el else ""
+    # codice e stili non sono testo visibile: via dal tree prima di estrarre il testo
+    # (il JSON-LD resta, contiene spesso email e telefono e serve a has_schema_org)
+    for node in tree.css(NON_TEXT_SELECTOR): node.decompose()
+    txt=safe_text(tree)
+    # un solo passaggio sul DOM per i link mailto: e tel:
+    mailto_links, tel_links=[], []
+    for a in tree.css('a[href^="mailto:"], a[href^="tel:"]'):
+        href=a.attributes["href"]
+        if href.startswith("mailto:"): mailto_links.append(unquote(href[7:].split("?")[0]))
+        else: tel_links.append(unquote(href[4:]))
+    info["emails"], info["phones"]=extract_contacts(txt, mailto_links, tel_links)
+    anchors=analyze_anchors(tree, landing_url)
+    info["contact_page"]=anchors["contact_page"]
+    info["has_contact_form"]=bool(tree.css_first("form"))
+    info["has_schema"]=has_schema_org(tree)
+    info["has_cta"]=anchors["has_cta"]
+    # il punteggio si stabilizza ben prima di COPY_TEXT_LIMIT caratteri: oltre non serve leggere
+    buf, total=[], 0
+    for p in tree.css("p, h1, h2, h3"):
+        t=p.text(separator=" ",strip=True)
+        buf.append(t)
+        total+=len(t)
+        if total>=COPY_TEXT_LIMIT: break
+    info["copy_quality"]=copy_quality_score(" ".join(buf)[:COPY_TEXT_LIMIT])
     raw=0
     if info["emails"]: raw+=WEIGHTS["has_email"]
     if info["phones"]: raw+=WEIGHTS["has_phone"]
@@ -212,78 +458,226 @@ def analyze_landing(page, landing_url):
     raw+=int(info["copy_quality"]*WEIGHTS["good_copy"])
     if info["has_cta"]: raw+=WEIGHTS["has_cta"]
     info["score"]=normalize_score(raw)
+    await acache_set(landing_cache_key(landing_url), CACHE_TTL, info)
     return info
 
+# ---------------- BROWSER ----------------
+def is_tracker(url):
+    labels = (urlparse(url).hostname or "").split(".")
+    return any(".".join(labels[i:]) in TRACKER_DOMAINS for i in range(len(labels) - 1))
+
+async def block_heavy_resources(route):
+    req = route.request
+    if req.resource_type in BLOCKED_RESOURCES or (req.resource_type != "document" and is_tracker(req.url)):
+        await route.abort()
+    else: await route.continue_()
+
+_browsers_checked = False
+
+def ensure_browsers_installed():
+    # se i browser non sono installati, li installa una volta sola;
+    # il lock evita che più worker gunicorn installino in parallelo
+    global _browsers_checked
+    if _browsers_checked: return
+    if not os.path.exists(BROWSERS_DIR):
+        os.makedirs(os.path.dirname(BROWSERS_DIR), exist_ok=True)
+        with open(BROWSERS_DIR + ".lock", "w") as lock:
+            if fcntl: fcntl.flock(lock, fcntl.LOCK_EX)
+            if not os.path.exists(BROWSERS_DIR):
+                print("Playwright browsers non trovati, installo Chromium...")
+                subprocess.run(["playwright", "install", "chromium"], check=True)
+    _browsers_checked = True
+
+# un solo Chromium per processo, lanciato alla prima pipeline e riusato dalle successive;
+# vive su un event loop dedicato perché gli oggetti async di Playwright sono legati al loop
+_loop = None
+_loop_lock = threading.Lock()
+_pw = None
+_browser = None
+_browser_lock = None
+
+def get_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="playwright-loop", daemon=True).start()
+    return _loop
+
+async def get_browser():
+    global _pw, _browser, _browser_lock
+    if _browser_lock is None: _browser_lock = asyncio.Lock()
+    async with _browser_lock:
+        if _browser is None or not _browser.is_connected():
+            if _pw is None: _pw = await async_playwright().start()
+            _browser = await _pw.chromium.launch(
+                headless=True,
+                args=[
+                    "--no-sandbox",
+                    "--disable-dev-shm-usage",
+                    "--disable-gpu",
+                    "--single-process",
+                    "--disable-background-networking",
+                    "--disable-background-timer-throttling",
+                    "--disable-client-side-phishing-detection",
+                    "--disable-default-apps",
+                    "--disable-extensions",
+                ],
+                timeout=60000
+            )
+    return _browser
+
+async def _close_shared():
+    global _pw, _browser, _http_client
+    if _http_client is not None:
+        try: await _http_client.aclose()
+        except: pass
+    if _browser is not None:
+        try: await _browser.close()
+        except: pass
+    if _pw is not None:
+        try: await _pw.stop()
+        except: pass
+    _pw = _browser = _http_client = None
+
+@atexit.register
+def close_shared():
+    if _loop is None: return
+    try: asyncio.run_coroutine_threadsafe(_close_shared(), _loop).result(timeout=10)
+    except: pass
+
 # ---------------- PIPELINE ----------------
-def run_pipeline(query):
+async def scrape_platform(page, platform, query):
+    if platform=="meta": return await scrape_meta_ads(page, query, MAX_PER_PLATFORM)
+    if platform=="reddit": return await scrape_reddit(page, query, MAX_PER_PLATFORM)
+    if platform=="linkedin": return await scrape_linkedin(page, query, MAX_PER_PLATFORM)
+    return []
+
+async def run_pipeline_async(query, browser=None):
     results=[]
     per_platform=defaultdict(int)
     per_domain_count=defaultdict(int)
 
-    with sync_playwright() as pw:
-        browser = pw.chromium.launch(
-            headless=True,
-            args=[
-                "--no-sandbox",
-                "--disable-dev-shm-usage",
-                "--disable-gpu",
-                "--single-process",
-                "--disable-background-networking",
-                "--disable-background-timer-throttling",
-                "--disable-client-side-phishing-detection",
-                "--disable-default-apps",
-                "--disable-extensions",
-            ],
-            timeout=60000
-        )
+    if browser is None: browser=await get_browser()
+    # pool di contesti incognito (cookie isolati, UA diverso): acquire con contexts.get(),
+    # release con contexts.put_nowait(); a fine pipeline si chiudono loro, non il browser
+    opened=[]
+    try:
+        contexts=asyncio.Queue()
+        for _ in range(POOL_SIZE):
+            context=await browser.new_context(user_agent=random_ua(), service_workers="block")
+            opened.append(context)
+            await context.route("**/*", block_heavy_resources)
+            contexts.put_nowait(context)
+
+        client=get_http_client()
+        pending=defaultdict(list)  # dominio -> candidati in attesa di analisi
+        queued=defaultdict(int)
+        workers={}  # dominio -> task
+        next_allowed={}  # "schema://host" -> istante (monotonic) da cui si può fare la prossima richiesta
+        # landing normalizzata -> indice in PLATFORMS della prima piattaforma che la elenca
+        credit={}
+
+        # 2) analisi: un worker per dominio, domini diversi in parallelo;
+        #    il worker consuma i candidati del suo dominio man mano che gli scraper li producono
+        async def domain_worker(dom):
+            while pending[dom]:
+                platform, cand=pending[dom].pop(0)
+                if per_domain_count[dom]>=MAX_PER_DOMAIN: break
+                if per_platform[platform]>=MAX_PER_PLATFORM: continue
+                per_platform[platform]+=1  # prenota lo slot prima di attendere
+
+                analysis=await acache_get(landing_cache_key(cand["landing"]))
+                cached=analysis is not None
+                if not cached:
+                    # la pausa si fa prima della richiesta successiva, non dopo l'ultima:
+                    # un worker senza altro da fare finisce subito
+                    origin=origin_of(cand["landing"])
+                    delay=await crawl_delay(client, origin)
+                    wait=next_allowed.get(origin, 0)-time.monotonic()
+                    if wait>0: await asyncio.sleep(wait)
+                    context=await contexts.get()
+                    try:
+                        analysis=await analyze_landing(context, cand["landing"], client)
+                    except:
+                        per_platform[platform]-=1
+                        continue
+                    finally:
+                        contexts.put_nowait(context)
+                        next_allowed[origin]=time.monotonic()+delay
+
+                lead={
+                    "platform": platform,
+                    "source_title": cand.get("title") or cand.get("text",""),
+                    "landing": cand["landing"],
+                    "domain": dom,
+                    "analysis": analysis,
+                    "collected_at": time.strftime("%Y-%m-%d %H:%M:%S")
+                }
+                results.append(lead)
+                per_domain_count[dom]+=1
+
+        def enqueue(platform, cand):
+            landing=cand.get("landing")
+            if not landing or not has_host(landing) or is_blocked_social(landing): return
+            dom=domain_of(landing)
+            if queued[dom]>=MAX_PER_DOMAIN: return
+            queued[dom]+=1
+            pending[dom].append((platform, cand))
+            # un worker ancora attivo ricontrolla la coda dopo la pausa: se ne crea uno solo se è finito
+            if dom not in workers or workers[dom].done():
+                workers[dom]=asyncio.create_task(domain_worker(dom))
+
+        # 1) le tre piattaforme in parallelo, ognuna nel suo contesto; i candidati passano
+        #    all'analisi appena il loro scraper finisce, senza aspettare gli altri
+        async def scrape_into_queue(platform):
+            context=await contexts.get()
+            page=await context.new_page()
+            try:
+                cands=await scrape_platform(page, platform, query)
+            except Exception as e:
+                print(f"[WARN] scraping {platform} fallito: {e}")
+                return
+            finally:
+                await page.close()
+                contexts.put_nowait(context)
+            rank=PLATFORMS.index(platform)
+            for cand in cands:
+                norm=normalize_url(cand["landing"])
+                if norm in credit:
+                    # già in analisi: si ricorda solo se questa piattaforma viene prima
+                    credit[norm]=min(credit[norm], rank)
+                    continue
+                credit[norm]=rank
+                enqueue(platform, cand)
+
         try:
-            with browser.new_page() as page:
-                try: page.set_extra_http_headers({"User-Agent": ua.random})
-                except: pass
-
-                for platform in PLATFORMS:
-                    if per_platform[platform]>=MAX_PER_PLATFORM: continue
-                    if platform=="meta": candidates=scrape_meta_ads(page, query, MAX_PER_PLATFORM)
-                    elif platform=="reddit": candidates=scrape_reddit(page, query, MAX_PER_PLATFORM)
-                    elif platform=="linkedin": candidates=scrape_linkedin(page, query, MAX_PER_PLATFORM)
-                    else: candidates=[]
-
-                    for cand in candidates:
-                        if per_platform[platform]>=MAX_PER_PLATFORM: break
-                        landing=cand.get("landing")
-                        if not landing or is_blocked_social(landing): continue
-                        dom=domain_of(landing)
-                        if per_domain_count[dom]>=MAX_PER_DOMAIN: continue
-
-                        try:
-                            with browser.new_page() as landing_page:
-                                try: landing_page.set_extra_http_headers({"User-Agent": ua.random})
-                                except: pass
-                                analysis=analyze_landing(landing_page, landing)
-                        except: continue
-
-                        lead={
-                            "platform": platform,
-                            "source_title": cand.get("title") or cand.get("text",""),
-                            "landing": landing,
-                            "domain": dom,
-                            "analysis": analysis,
-                            "collected_at": time.strftime("%Y-%m-%d %H:%M:%S")
-                        }
-                        results.append(lead)
-                        per_platform[platform]+=1
-                        per_domain_count[dom]+=1
-                        time.sleep(POLITE_SLEEP)
+            await asyncio.gather(*(scrape_into_queue(platform) for platform in PLATFORMS))
+            await asyncio.gather(*workers.values())
         finally:
-            browser.close()
+            for task in workers.values(): task.cancel()
+    finally:
+        for context in opened:
+            try: await context.close()
+            except: pass
 
-    sorted_results=sorted(results, key=lambda r:r["analysis"].get("score",0), reverse=True)
-    with open("leads.json","w", encoding="utf-8") as f:
-        json.dump(sorted_results, f, ensure_ascii=False, indent=2)
+    # una landing trovata su più piattaforme va alla prima in ordine di PLATFORMS,
+    # non a quella che ha finito lo scraping per prima
+    for lead in results:
+        lead["platform"]=PLATFORMS[credit[normalize_url(lead["landing"])]]
+    results.sort(key=lambda r:r["analysis"].get("score",0), reverse=True)
+    sorted_results=results
+    # serializzato in memoria e scritto con una sola write (json.dump fa una write per frammento)
+    with open("leads.json","wb") as f:
+        f.write(orjson.dumps(sorted_results, option=orjson.OPT_INDENT_2))
 
     print(f"Saved {len(sorted_results)} leads to leads.json")
     return sorted_results
 
+def run_pipeline(query):
+    ensure_browsers_installed()
+    return asyncio.run_coroutine_threadsafe(run_pipeline_async(query), get_loop()).result()
+
 # ---------------- ENTRY ----------------
 if __name__=="__main__":
     q=input(QUERY_PROMPT).strip()